@@ -11,38 +11,44 @@ Usage: python polgar.py > problems.json
 import chess
 import chess.engine
 import chess.pgn
-import json
+import orjson
 import sys
 import os
 import argparse
+import functools
 import multiprocessing
-from typing import Any
-from chess.pgn import read_game
+import multiprocessing.util
+from collections import deque
+from chess.pgn import read_game, skip_game
 from dotenv import load_dotenv
 
 load_dotenv()
 
 STOCKFISH_PATH = os.getenv("STOCKFISH_PATH", "stockfish")
 
-# Number of parallel workers (CPU count - 1, minimum 1)
-NUM_WORKERS = max(1, multiprocessing.cpu_count() - 1)
+# Stockfish search threads per worker; SMP helps the deep mate-in-3/4 stragglers
+ENGINE_THREADS = 2
 
+# Spelled-out mate counts used in the PGN "White" header
+NUMBER_WORDS = {
+    "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
+    "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10
+}
 
+
+# Only a handful of distinct type/first-move strings exist, so cache results
+@functools.lru_cache(maxsize=32)
 def parse_mate_count(move_type: str) -> int | None:
     """Extract mate count from type like 'Mate in two' -> 2."""
-    words = move_type.lower().split()
-    number_words = {
-        "one": 1, "two": 2, "three": 3, "four": 4, "five": 5,
-        "six": 6, "seven": 7, "eight": 8, "nine": 9, "ten": 10
-    }
-    for word in words:
-        if word in number_words:
-            return number_words[word]
+    for word in move_type.lower().split():
+        if word in NUMBER_WORDS:
+            return NUMBER_WORDS[word]
         if word.isdigit():
             return int(word)
     return None
 
 
+@functools.lru_cache(maxsize=32)
 def title_case(s: str) -> str:
     """Convert 'Mate in one' to 'Mate in One' (preserving lowercase 'in', 'to')."""
     words = s.split()
@@ -55,14 +61,33 @@ def title_case(s: str) -> str:
     return " ".join(result)
 
 
-def extract_pgn_moves(game: chess.pgn.Game) -> list[str]:
-    """Extract mainline moves from PGN game as UCI strings."""
-    moves = []
-    board = game.board()
-    for move in game.mainline_moves():
-        moves.append(move.uci())
-        board.push(move)
-    return moves
+class PuzzleVisitor(chess.pgn.BaseVisitor[tuple[chess.pgn.Headers, list[str]]]):
+    """PGN visitor collecting headers and mainline moves as UCI strings.
+
+    Unlike the default GameBuilder, this never builds a GameNode tree.
+    """
+
+    def begin_game(self) -> None:
+        self.headers = chess.pgn.Headers()
+        self.moves: list[str] = []
+
+    def begin_headers(self) -> chess.pgn.Headers:
+        return self.headers
+
+    def visit_header(self, tagname: str, tagvalue: str) -> None:
+        self.headers[tagname] = tagvalue
+
+    def begin_variation(self) -> chess.pgn.SkipType:
+        return chess.pgn.SKIP
+
+    def visit_move(self, board: chess.Board, move: chess.Move) -> None:
+        self.moves.append(move.uci())
+
+    def handle_error(self, error: Exception) -> None:
+        print(f"Warning: {error} while parsing PGN", file=sys.stderr)
+
+    def result(self) -> tuple[chess.pgn.Headers, list[str]]:
+        return self.headers, self.moves
 
 
 def add_line_to_tree(tree: dict, moves: list[str]) -> None:
@@ -75,138 +100,188 @@ def add_line_to_tree(tree: dict, moves: list[str]) -> None:
     add_line_to_tree(tree[move], moves[1:])
 
 
-def find_alt_promotions(
-    tree: dict, current_board: chess.Board, path: list[str] | None = None
-) -> None:
-    """Recursively find alternative promotions that result in checkmate."""
-    if path is None:
-        path = []
-    for move, subtree in list(tree.items()):
-        if not subtree:
-            # Terminal node - check if we can add alternative promotions
-            if len(move) == 5:  # Promotion move
-                base_move = move[:4]
-                current_promo = move[4]
-                for promo in ['q', 'r', 'b', 'n']:
-                    if promo != current_promo:
-                        alt_move = base_move + promo
-                        if alt_move not in tree:
-                            try:
-                                test_board = current_board.copy()
-                                test_board.push_uci(alt_move)
-                                if test_board.is_checkmate():
-                                    tree[alt_move] = {}
-                            except (ValueError, chess.InvalidMoveError):
-                                pass
-        else:
-            new_board = current_board.copy()
-            new_board.push_uci(move)
-            find_alt_promotions(subtree, new_board, path + [move])
+def get_tree_depth(tree: dict) -> int:
+    """Get the depth of the solution tree (longest line, in plies)."""
+    max_depth = 0
+    queue = deque([(tree, 0)])
+    while queue:
+        node, depth = queue.popleft()
+        if not node:
+            max_depth = max(max_depth, depth)
+        for subtree in node.values():
+            queue.append((subtree, depth + 1))
+    return max_depth
+
+
+def find_alt_promotions(tree: dict, board: chess.Board) -> None:
+    """Find alternative promotions on final moves that also result in checkmate.
+
+    Walks the tree with an explicit stack, making and unmaking moves on
+    `board` instead of copying it; the board is restored on return.
+    """
+    stack = [(iter(list(tree.items())), tree)]
+    while stack:
+        moves, node = stack[-1]
+        entry = next(moves, None)
+        if entry is None:
+            stack.pop()
+            if stack:
+                board.pop()
+            continue
+
+        move, subtree = entry
+        if subtree:
+            board.push_uci(move)
+            stack.append((iter(list(subtree.items())), subtree))
+            continue
+
+        # Terminal node - check if we can add alternative promotions
+        if len(move) == 5:  # Promotion move
+            orig = chess.Move.from_uci(move)
+            for promo in (chess.QUEEN, chess.ROOK, chess.BISHOP, chess.KNIGHT):
+                if promo != orig.promotion:
+                    alt_move = chess.Move(orig.from_square, orig.to_square, promotion=promo)
+                    alt_uci = alt_move.uci()
+                    if alt_uci not in node and board.is_legal(alt_move):
+                        board.push(alt_move)
+                        is_mate = board.is_checkmate()
+                        board.pop()
+                        if is_mate:
+                            node[alt_uci] = {}
 
 
 # Type alias for puzzle data tuple
 PuzzleData = tuple[int, str, str, str, int | None, list[str]]
 
-def solve_puzzle(puzzle_data: PuzzleData) -> dict[str, Any]:
-    """Worker function: solve a single puzzle with its own Stockfish instance.
+# Worker result: (problemid, first, type, fen, solutions, depth). A tuple
+# pickles smaller than a dict since key strings aren't repeated per result.
+PuzzleResult = tuple[int, str, str, str, dict, int]
+
+# Per-process Stockfish instance, created once by _init_worker
+_worker_engine: chess.engine.SimpleEngine | None = None
+
+
+def _quit_worker_engine() -> None:
+    """Shut down this worker's Stockfish instance."""
+    global _worker_engine
+    if _worker_engine is not None:
+        _worker_engine.quit()
+        _worker_engine = None
+
+
+def _init_worker(threads: int) -> None:
+    """Pool initializer: start one Stockfish instance per worker process.
+
+    Reusing the engine across puzzles avoids a process spawn and UCI
+    handshake for every puzzle.
+    """
+    global _worker_engine
+    _worker_engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
+    _worker_engine.configure({
+        "Threads": threads,
+        "Hash": 512,  # 512 MB hash table per engine, shared across puzzles
+    })
+    # atexit hooks don't run in pool workers; multiprocessing finalizers do
+    multiprocessing.util.Finalize(None, _quit_worker_engine, exitpriority=10)
+
+
+def solve_puzzle(puzzle_data: PuzzleData) -> PuzzleResult:
+    """Worker function: solve a single puzzle with this worker's Stockfish instance.
 
     Uses iterative deepening: starts shallow and only goes deeper if needed.
     """
     problemid, fen, move_type, first_move, mate_count, pgn_moves = puzzle_data
 
-    # Each worker creates its own engine instance
-    engine = chess.engine.SimpleEngine.popen_uci(STOCKFISH_PATH)
-    engine.configure({"Hash": 128})  # 128 MB hash table per engine
-
-    try:
-        solutions = {}
-        if mate_count:
-            board = chess.Board(fen)
-
-            # Adaptive MultiPV: fewer candidates for mate in 1
-            multipv = 20 if mate_count == 1 else 50
-
-            # Iterative deepening: start shallow, go deeper only if needed
-            # Tuned per difficulty based on empirical testing
-            if mate_count == 1:
-                depth_levels = [1, 2, 4, 8]
-            elif mate_count == 2:
-                depth_levels = [8, 12, 18, 26]
-            elif mate_count == 3:
-                depth_levels = [10, 14, 20, 28]
-            else:
-                # Mate in 3+: use formula
-                depth_levels = [
-                    mate_count * 4 + 4,
-                    mate_count * 6 + 8,
-                    mate_count * 8 + 12,
-                    mate_count * 10 + 16,
-                ]
-
-            info = None
-            used_depth = 0
-            expected_pv_len = mate_count * 2 - 1  # Full line: first move + continuation
-            expected_cont_len = (mate_count - 1) * 2  # Continuation without first move
-
-            for depth in depth_levels:
-                info = engine.analyse(
-                    board,
-                    chess.engine.Limit(depth=depth),
-                    multipv=multipv
-                )
-
-                # Check if we found valid mate solutions with full continuation
-                found_complete = False
-                for pv_info in info:
-                    score = pv_info.get("score")
-                    if score and score.is_mate():
-                        mate_value = score.relative.mate()
-                        pv = pv_info.get("pv", [])
-                        cont_len = len(pv) - 1  # Continuation = PV minus first move
-                        # Accept only if correct mate count AND full continuation
-                        if mate_value == mate_count and cont_len >= expected_cont_len:
-                            found_complete = True
-                            break
-
-                if found_complete:
-                    used_depth = depth
-                    break  # Found complete solution
-
-            # Get the original first move and continuation from polgar.pgn
-            pgn_first_move = pgn_moves[0] if pgn_moves else None
-            pgn_continuation = pgn_moves[1:] if len(pgn_moves) > 1 else []
-
-            for pv_info in info:
-                score = pv_info.get("score")
-                if score and score.is_mate():
-                    mate_value = score.relative.mate()
-                    if mate_value == mate_count:
-                        pv = pv_info.get("pv", [])
-                        if pv:
-                            first = pv[0].uci()
-
-                            # Prefer polgar.pgn continuation if this is the original first move
-                            # AND the PGN has correct length (some PGN entries are incomplete)
-                            if first == pgn_first_move and len(pgn_continuation) == expected_cont_len:
-                                line = [first] + pgn_continuation
-                            else:
-                                line = [m.uci() for m in pv]
-
-                            add_line_to_tree(solutions, line)
-
-            # Check for alternative promotions on final move that also result in checkmate
-            find_alt_promotions(solutions, board)
-
-        return {
-            "problemid": problemid,
-            "first": title_case(first_move),
-            "type": title_case(move_type),
-            "fen": fen,
-            "solutions": solutions,
-            "_depth": used_depth  # Internal: for statistics
-        }
-    finally:
-        engine.quit()
+    engine = _worker_engine
+    if engine is None:
+        raise RuntimeError("solve_puzzle called outside an initialized worker")
+
+    solutions = {}
+    used_depth = 0
+    if mate_count:
+        board = chess.Board(fen)
+
+        # Adaptive MultiPV: fewer candidates for mate in 1
+        multipv = 20 if mate_count == 1 else 50
+
+        # Iterative deepening: start shallow, go deeper only if needed
+        # Tuned per difficulty based on empirical testing
+        if mate_count == 1:
+            depth_levels = [1, 2, 4, 8]
+        elif mate_count == 2:
+            depth_levels = [8, 12, 18, 26]
+        elif mate_count == 3:
+            depth_levels = [10, 14, 20, 28]
+        else:
+            # Mate in 3+: use formula
+            depth_levels = [
+                mate_count * 4 + 4,
+                mate_count * 6 + 8,
+                mate_count * 8 + 12,
+                mate_count * 10 + 16,
+            ]
+
+        info = None
+        expected_pv_len = mate_count * 2 - 1  # Full line: first move + continuation
+        expected_cont_len = (mate_count - 1) * 2  # Continuation without first move
+
+        for depth in depth_levels:
+            # No game id: python-chess only sends ucinewgame for the first
+            # puzzle, so hash entries from earlier puzzles stay usable
+            info = engine.analyse(
+                board,
+                chess.engine.Limit(depth=depth),
+                multipv=multipv,
+                # Only score and pv are read below; skip parsing the rest
+                info=chess.engine.INFO_SCORE | chess.engine.INFO_PV
+            )
+
+            # Check if we found valid mate solutions with full continuation:
+            # correct mate count AND continuation (PV minus first move) complete
+            found_complete = any(
+                pv_info.get("score") and pv_info["score"].is_mate()
+                and pv_info["score"].relative.mate() == mate_count
+                and len(pv_info.get("pv", [])) - 1 >= expected_cont_len
+                for pv_info in info
+            )
+
+            if found_complete:
+                used_depth = depth
+                break  # Found complete solution
+
+        # Get the original first move and continuation from polgar.pgn
+        pgn_first_move = pgn_moves[0] if pgn_moves else None
+        pgn_continuation = pgn_moves[1:] if len(pgn_moves) > 1 else []
+
+        for pv_info in info:
+            score = pv_info.get("score")
+            if score and score.is_mate():
+                mate_value = score.relative.mate()
+                if mate_value == mate_count:
+                    pv = pv_info.get("pv", [])
+                    if pv:
+                        first = pv[0].uci()
+
+                        # Prefer polgar.pgn continuation if this is the original first move
+                        # AND the PGN has correct length (some PGN entries are incomplete)
+                        if first == pgn_first_move and len(pgn_continuation) == expected_cont_len:
+                            line = [first] + pgn_continuation
+                        else:
+                            line = [m.uci() for m in pv]
+
+                        add_line_to_tree(solutions, line)
+
+        # Check for alternative promotions on final move that also result in checkmate
+        find_alt_promotions(solutions, board)
+
+    return (
+        problemid,
+        title_case(first_move),
+        title_case(move_type),
+        fen,
+        solutions,
+        used_depth,
+    )
 
 
 def extract_puzzles_from_pgn(pgn_path: str, start: int, end: int) -> list[PuzzleData]:
@@ -215,20 +290,24 @@ def extract_puzzles_from_pgn(pgn_path: str, start: int, end: int) -> list[Puzzle
 
     with open(pgn_path, encoding="latin-1") as f:
         # Skip the first game (credits/intro)
-        read_game(f)
+        skip_game(f)
 
         for i in range(1, end + 1):
-            g = read_game(f)
-            if g is None:
-                print(f"Warning: Only found {i-1} problems in PGN", file=sys.stderr)
-                break
-
             if i < start:
+                if not skip_game(f):
+                    print(f"Warning: Only found {i-1} problems in PGN", file=sys.stderr)
+                    break
                 continue
 
-            fen = g.headers.get("FEN", "")
-            move_type = g.headers.get("White", "")  # e.g., "Mate in one"
-            first_move = g.headers.get("Black", "")  # e.g., "White to move"
+            game = read_game(f, Visitor=PuzzleVisitor)
+            if game is None:
+                print(f"Warning: Only found {i-1} problems in PGN", file=sys.stderr)
+                break
+
+            headers, pgn_moves = game
+            fen = headers.get("FEN", "")
+            move_type = headers.get("White", "")  # e.g., "Mate in one"
+            first_move = headers.get("Black", "")  # e.g., "White to move"
 
             if not fen:
                 print(f"Warning: Problem {i} has no FEN, skipping", file=sys.stderr)
@@ -236,9 +315,6 @@ def extract_puzzles_from_pgn(pgn_path: str, start: int, end: int) -> list[Puzzle
 
             mate_count = parse_mate_count(move_type)
 
-            # Extract original moves from PGN
-            pgn_moves = extract_pgn_moves(g)
-
             puzzles.append((i, fen, move_type, first_move, mate_count, pgn_moves))
 
     return puzzles
@@ -249,23 +325,52 @@ def main() -> None:
     parser.add_argument("--pgn", default="polgar.pgn", help="Path to PGN file")
     parser.add_argument("--start", type=int, default=1, help="Start problem ID (inclusive)")
     parser.add_argument("--end", type=int, default=4462, help="End problem ID (inclusive)")
-    parser.add_argument("--workers", type=int, default=NUM_WORKERS, help="Number of parallel workers")
+    parser.add_argument("--workers", type=int, default=None, help="Number of parallel workers")
+    parser.add_argument("--threads", type=int, default=ENGINE_THREADS, help="Stockfish threads per worker")
     args = parser.parse_args()
+    if args.threads < 1:
+        parser.error("--threads must be at least 1")
+    if args.workers is not None and args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    # Default workers: (CPU count - 1) divided by engine threads, minimum 1
+    if args.workers is None:
+        args.workers = max(1, (multiprocessing.cpu_count() - 1) // args.threads)
 
     print(f"Extracting puzzles from PGN...", file=sys.stderr)
     puzzles = extract_puzzles_from_pgn(args.pgn, args.start, args.end)
     print(f"Found {len(puzzles)} puzzles", file=sys.stderr)
 
-    print(f"Solving with {args.workers} parallel workers...", file=sys.stderr)
+    # Longest tasks first (deepest mates) so workers don't idle on a straggler
+    puzzles.sort(key=lambda p: -(p[4] or 0))
+
+    print(
+        f"Solving with {args.workers} parallel workers, {args.threads} engine threads each...",
+        file=sys.stderr
+    )
 
     # Solve puzzles in parallel
-    with multiprocessing.Pool(processes=args.workers) as pool:
-        # Use imap for progress tracking
+    with multiprocessing.Pool(
+        processes=args.workers, initializer=_init_worker, initargs=(args.threads,)
+    ) as pool:
+        # Use imap_unordered for progress tracking; results are sorted below.
+        # Small chunks cut per-task IPC for the many fast mate-in-1 puzzles.
         results = []
-        for i, result in enumerate(pool.imap(solve_puzzle, puzzles), 1):
-            results.append(result)
+        for i, result in enumerate(pool.imap_unordered(solve_puzzle, puzzles, chunksize=8), 1):
+            problemid, first, move_type, fen, solutions, used_depth = result
+            results.append({
+                "problemid": problemid,
+                "first": first,
+                "type": move_type,
+                "fen": fen,
+                "solutions": solutions,
+                "_depth": used_depth  # Internal: for statistics
+            })
             if i % 100 == 0 or i == len(puzzles):
                 print(f"Solved {i}/{len(puzzles)} puzzles...", file=sys.stderr)
+        # Let workers exit normally so their engines are shut down cleanly
+        pool.close()
+        pool.join()
 
     # Sort by problem ID
     results.sort(key=lambda x: x["problemid"])
@@ -289,12 +394,6 @@ def main() -> None:
         # Expected depth: mate_count * 2 - 1 (first move + alternating moves)
         expected_depth = mate_count * 2 - 1 if mate_count else 0
 
-        def get_tree_depth(tree, depth=0):
-            """Get the depth of the solution tree."""
-            if not tree:
-                return depth
-            return max(get_tree_depth(subtree, depth + 1) for subtree in tree.values())
-
         actual_depth = get_tree_depth(solutions)
         if actual_depth != expected_depth:
             actual_mate = (actual_depth + 1) // 2
@@ -347,7 +446,8 @@ def main() -> None:
 
     # Output JSON
     output = {"problems": results}
-    print(json.dumps(output, indent=4))
+    # orjson only supports 2-space indentation
+    sys.stdout.buffer.write(orjson.dumps(output, option=orjson.OPT_INDENT_2) + b"\n")
 
 
 if __name__ == "__main__":